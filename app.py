@@ -1,16 +1,32 @@
 # app.py
 import os
+import re
+import mmap
 import time
 import uuid
 import json
+import queue
+import atexit
+import shutil
+import struct
 import logging
 import base64
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from typing import Tuple, Optional, Dict, Any, List
 from flask import Flask, request, send_file, jsonify, make_response
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from cachetools import LRUCache
+import msgspec
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # optional replicate import
 try:
@@ -18,19 +34,50 @@ try:
 except Exception:
     replicate = None
 
+# optional io_uring binding (linux-only): batches video writes into single
+# kernel submissions; we fall back to shutil.copyfileobj without it
+try:
+    import liburing
+except Exception:
+    liburing = None
+
+# optional celery import (background generation; needs REDIS_URL)
+try:
+    from celery import Celery
+except Exception:
+    Celery = None
+
 # ---------- Basic config ----------
 ROOT = Path(__file__).parent.resolve()
 VIDEO_DIR = ROOT / "generated_videos"
 VIDEO_DIR.mkdir(exist_ok=True)
+# In-memory index of generated video filenames so /api/list-videos doesn't
+# re-scan the directory on every request; writers add names as files land.
+# Other gunicorn/celery workers add files too, so the index is re-scanned
+# when older than VIDEO_INDEX_TTL seconds.
+def _scan_video_dir() -> set:
+    with os.scandir(VIDEO_DIR) as it:
+        return {e.name for e in it if e.name.endswith((".mp4", ".webm", ".gif"))}
+
+VIDEO_INDEX: set = _scan_video_dir()
+VIDEO_INDEX_TTL = 5.0
+_video_index_scanned = time.monotonic()
 SESSIONS_DIR = ROOT / "sessions"
 SESSIONS_DIR.mkdir(exist_ok=True)
 LOG_DIR = ROOT / "logs"
 LOG_DIR.mkdir(exist_ok=True)
 SAMPLE_ASSET = ROOT / "sample_assets" / "sample.mp4"
-CACHE_FILE = ROOT / "cache.json"
+# Read the mock sample once at startup; the request path never touches the
+# asset on disk again (mock branches test SAMPLE_BYTES instead of stat-ing)
+SAMPLE_BYTES: Optional[bytes] = SAMPLE_ASSET.read_bytes() if SAMPLE_ASSET.exists() else None
+CACHE_FILE = ROOT / "cache.mpk"
+LEGACY_CACHE_MSGPACK = ROOT / "cache.msgpack"
+LEGACY_CACHE_JSON = ROOT / "cache.json"
+CACHE_MAXSIZE = 10_000
 
 # env (Replicate)
 REPLICATE_API_TOKEN = os.environ.get("REPLICATE_API_TOKEN")
+REDIS_URL = os.environ.get("REDIS_URL")
 # Note: replicate.run takes the model slug; some model pages use "owner/model" or a version string
 REPLICATE_MODEL = os.environ.get("REPLICATE_MODEL", "minimax/video-01")
 
@@ -51,31 +98,125 @@ FAST_DEFAULTS: Dict[str, Any] = {
     "guidance_scale": 6,
 }
 
-# logging
-logging.basicConfig(
-    filename=str(LOG_DIR / "server.log"),
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(message)s",
-)
+# logging: request threads only enqueue records; a dedicated listener thread
+# does the actual disk writes, keeping log I/O out of request latency
+_log_queue: queue.Queue = queue.Queue(-1)
+_log_file_handler = logging.FileHandler(str(LOG_DIR / "server.log"))
+_log_file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+# attach the QueueHandler by hand: basicConfig would give it a default
+# formatter, which QueueHandler.prepare() bakes into the record before the
+# listener's FileHandler formats it again (double-prefixed lines)
+_root_logger = logging.getLogger()
+_root_logger.setLevel(logging.INFO)
+_root_logger.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, _log_file_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+class OrjsonProvider(JSONProvider):
+    """Route Flask's jsonify through orjson so large responses (session
+    transcripts, video lists) are C-encoded instead of going through the
+    stdlib encoder."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
+# With USE_X_SENDFILE=1 behind a front server that honors X-Sendfile (Apache
+# mod_xsendfile, lighttpd — not nginx), send_file emits only the header and
+# the front server streams the video itself. On bare gunicorn werkzeug uses
+# the WSGI file_wrapper, i.e. the kernel's sendfile(2). See README.
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE", "").lower() in ("1", "true", "yes")
+
+# ---------- Framed msgpack log helpers ----------
+# Both the prompt cache and session transcripts persist as append-only logs of
+# length-prefixed MessagePack frames (4-byte big-endian size + payload).
+# Shared encoder so we don't pay Encoder setup cost on every write.
+_msgpack_encoder = msgspec.msgpack.Encoder()
+
+def _append_frame(path: Path, obj):
+    buf = _msgpack_encoder.encode(obj)
+    with open(path, "ab") as f:
+        f.write(struct.pack(">I", len(buf)) + buf)
+
+def _read_frames(path: Path) -> list:
+    frames: list = []
+    if not path.exists():
+        return frames
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty log
+            return frames
+        with mm:
+            pos, end = 0, len(mm)
+            while pos + 4 <= end:
+                (size,) = struct.unpack_from(">I", mm, pos)
+                pos += 4
+                if pos + size > end:
+                    logging.warning("Truncated frame in %s; ignoring tail", path)
+                    break
+                frames.append(msgspec.msgpack.decode(mm[pos:pos + size]))
+                pos += size
+    return frames
 
 # ---------- Simple persistent cache helpers ----------
-def _load_cache() -> dict:
+# The prompt->file cache is a bounded LRU so it can't grow without limit, and
+# new entries are persisted as appended (norm, path) frames — O(1) per fill
+# regardless of how many prompts have ever been seen. The log is compacted to
+# just the live entries when replayed frames outnumber them 2:1.
+
+def _compact_cache_log(cache: LRUCache):
+    try:
+        tmp = CACHE_FILE.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            for norm, path in cache.items():
+                buf = _msgpack_encoder.encode((norm, path))
+                f.write(struct.pack(">I", len(buf)) + buf)
+        tmp.replace(CACHE_FILE)
+    except Exception:
+        logging.exception("Failed to compact cache log")
+
+def _load_cache() -> LRUCache:
+    cache = LRUCache(maxsize=CACHE_MAXSIZE)
     if CACHE_FILE.exists():
         try:
-            return json.loads(CACHE_FILE.read_text(encoding="utf-8"))
+            entries = _read_frames(CACHE_FILE)
         except Exception:
-            logging.exception("Failed to load cache.json; starting fresh.")
-            return {}
-    return {}
-
-def _save_cache(cache: dict):
+            logging.exception("Failed to replay cache.mpk; starting fresh.")
+            return cache
+        for norm, path in entries:
+            cache[norm] = path
+        if len(entries) > 2 * max(len(cache), 1):
+            _compact_cache_log(cache)
+        return cache
+    # one-shot migration from the older full-dict formats
+    legacy = {}
+    try:
+        if LEGACY_CACHE_MSGPACK.exists():
+            legacy = msgspec.msgpack.decode(LEGACY_CACHE_MSGPACK.read_bytes(), type=dict)
+        elif LEGACY_CACHE_JSON.exists():
+            legacy = json.loads(LEGACY_CACHE_JSON.read_text(encoding="utf-8"))
+    except Exception:
+        logging.exception("Failed to migrate legacy cache; starting fresh.")
+    for norm, path in legacy.items():
+        cache[norm] = path
+    if cache:
+        _compact_cache_log(cache)
+    return cache
+
+def _cache_put(norm: str, path: str):
+    cache[norm] = path
     try:
-        CACHE_FILE.write_text(json.dumps(cache, indent=2), encoding="utf-8")
+        _append_frame(CACHE_FILE, (norm, path))
     except Exception:
-        logging.exception("Failed to save cache.json")
+        logging.exception("Failed to append cache entry")
 
 def _normalize_prompt(p: str) -> str:
     return " ".join(p.strip().lower().split())
@@ -83,50 +224,232 @@ def _normalize_prompt(p: str) -> str:
 cache = _load_cache()
 
 # ---------- Session helpers ----------
+# Sessions are stored as an append-only log of length-prefixed MessagePack
+# frames ({sid}.mpk) so appending a message is a single O(1) write instead of
+# a full serialize+rewrite of the transcript. Immutable header fields (id,
+# created_at) live in a tiny sidecar {sid}.hdr.mpk written once at creation.
+# Parsed sessions are kept in a bounded in-process LRU so a request doesn't
+# re-read and re-decode the log multiple times; appends mutate the cached dict
+# and write through to disk. Bounded because long-running workers would
+# otherwise hold every transcript ever touched; evicted sessions are simply
+# re-read from their log on next use.
+SESSION_CACHE_MAXSIZE = 1024
+_SESSION_CACHE: LRUCache = LRUCache(maxsize=SESSION_CACHE_MAXSIZE)
+_session_cache_lock = threading.Lock()
+
+# Bounded ring of the latest messages per session, enough for the brief
+# builder (which only wants the last 6) without touching the full transcript
+RECENT_MESSAGES = 32
+_SESSION_RECENT: LRUCache = LRUCache(maxsize=SESSION_CACHE_MAXSIZE)
+
+# Expected byte size of each session's log (size at last disk read plus every
+# frame this process has appended since). With several gunicorn/celery workers
+# appending to the same logs, a cached session is stale once the file on disk
+# outgrows what this process accounts for — load_session compares and reloads.
+_SESSION_LOG_SIZE: LRUCache = LRUCache(maxsize=SESSION_CACHE_MAXSIZE)
+
+# Path objects per sid are built once and reused — four callsites per request
+# otherwise each pay f-string + Path construction. Entries are tiny, so the
+# bound is looser than the session caches'
+_session_paths: LRUCache = LRUCache(maxsize=8 * SESSION_CACHE_MAXSIZE)
+
+def _session_paths_for(sid: str) -> Tuple[Path, Path]:
+    paths = _session_paths.get(sid)
+    if paths is None:
+        paths = (SESSIONS_DIR / f"{sid}.mpk", SESSIONS_DIR / f"{sid}.hdr.mpk")
+        _session_paths[sid] = paths
+    return paths
+
+def _session_log_path(sid: str) -> Path:
+    return _session_paths_for(sid)[0]
+
+def _session_header_path(sid: str) -> Path:
+    return _session_paths_for(sid)[1]
+
+# Encoded frames are buffered per sid and flushed in one write per session —
+# by a timer thread, on a size threshold, at end of request, and at exit —
+# instead of paying a separate open+write syscall pair per message
+_PENDING: Dict[str, bytearray] = defaultdict(bytearray)
+_pending_lock = threading.Lock()
+# Serializes whole pop-and-write cycles: the timer thread, request teardowns
+# and threshold flushes all call _flush_pending concurrently, and two flushers
+# holding different buffers for the same sid could otherwise append them out
+# of order. Appends only ever contend on the cheaper _pending_lock.
+_flush_io_lock = threading.Lock()
+FLUSH_INTERVAL = 0.25   # seconds
+FLUSH_THRESHOLD = 64 * 1024  # bytes per sid before an immediate flush
+
+def _flush_pending(sid: Optional[str] = None):
+    with _flush_io_lock:
+        with _pending_lock:
+            if sid is None:
+                items = [(s, buf) for s, buf in _PENDING.items() if buf]
+                _PENDING.clear()
+            else:
+                buf = _PENDING.pop(sid, None)
+                items = [(sid, buf)] if buf else []
+        for s, buf in items:
+            try:
+                with open(_session_log_path(s), "ab") as f:
+                    f.write(buf)
+            except Exception:
+                logging.exception("Failed to flush session log %s", s)
+
+def _pending_flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        _flush_pending()
+
+_pending_flush_thread = threading.Thread(target=_pending_flush_loop, daemon=True, name="session-flush")
+_pending_flush_thread.start()
+atexit.register(_flush_pending)
+
+@app.teardown_appcontext
+def _flush_pending_on_teardown(exc):
+    # one write per session per request instead of one per message
+    _flush_pending()
+
 def create_session() -> str:
     sid = uuid.uuid4().hex
-    path = SESSIONS_DIR / f"{sid}.json"
-    data = {
-        "id": sid,
-        "created_at": datetime.utcnow().isoformat(),
-        "messages": []
-    }
-    path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+    header = {"id": sid, "created_at": datetime.utcnow().isoformat()}
+    _session_header_path(sid).write_bytes(_msgpack_encoder.encode(header))
+    with _session_cache_lock:
+        _SESSION_CACHE[sid] = {**header, "messages": []}
+        _SESSION_LOG_SIZE[sid] = 0
     return sid
 
+def _migrate_legacy_session(sid: str, legacy: Path) -> dict:
+    """Convert a pre-log {sid}.json session to the header + frame-log format
+    on first touch: write the header sidecar, re-emit the transcript as
+    frames (ahead of any frames already appended against the unmigrated
+    session), then rename the json so it can't shadow the log again."""
+    old = orjson.loads(legacy.read_bytes())
+    header = {"id": old.get("id", sid), "created_at": old.get("created_at", datetime.utcnow().isoformat())}
+    log_path = _session_log_path(sid)
+    _flush_pending(sid)
+    messages = old.get("messages", []) + _read_frames(log_path)
+    tmp = log_path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        for m in messages:
+            buf = _msgpack_encoder.encode(m)
+            f.write(struct.pack(">I", len(buf)) + buf)
+    tmp.replace(log_path)
+    _session_header_path(sid).write_bytes(_msgpack_encoder.encode(header))
+    legacy.rename(legacy.with_suffix(".json.migrated"))
+    logging.info("Migrated legacy session %s (%d messages)", sid, len(messages))
+    return {**header, "messages": messages}
+
+def _session_log_changed(sid: str) -> bool:
+    try:
+        actual = os.stat(_session_log_path(sid)).st_size
+    except OSError:
+        actual = 0
+    with _pending_lock:
+        pending = len(_PENDING.get(sid) or b"")
+    with _session_cache_lock:
+        expected = _SESSION_LOG_SIZE.get(sid)
+    if expected is None:
+        # size record evicted; be conservative and re-read
+        return True
+    # our not-yet-flushed frames are counted in expected but absent on disk
+    return actual != expected - pending
+
 def load_session(sid: str):
-    path = SESSIONS_DIR / f"{sid}.json"
-    if not path.exists():
-        return None
-    return json.loads(path.read_text(encoding="utf-8"))
+    with _session_cache_lock:
+        cached = _SESSION_CACHE.get(sid)
+    if cached is not None:
+        if not _session_log_changed(sid):
+            return cached
+        # another worker appended to this session; drop and re-read
+        with _session_cache_lock:
+            _SESSION_CACHE.pop(sid, None)
+            _SESSION_RECENT.pop(sid, None)
+    header_path = _session_header_path(sid)
+    if not header_path.exists():
+        legacy = SESSIONS_DIR / f"{sid}.json"
+        if legacy.exists():
+            data = _migrate_legacy_session(sid, legacy)
+        else:
+            return None
+    else:
+        # make sure buffered appends are on disk before a cold read
+        _flush_pending(sid)
+        data = msgspec.msgpack.decode(header_path.read_bytes())
+        data["messages"] = _read_frames(_session_log_path(sid))
+    try:
+        size = os.stat(_session_log_path(sid)).st_size
+    except OSError:
+        size = 0
+    with _session_cache_lock:
+        _SESSION_CACHE[sid] = data
+        _SESSION_LOG_SIZE[sid] = size
+        # the ring has its own LRU lifetime and can outlive a cache eviction;
+        # drop it whenever we re-read from disk so it's rebuilt fresh
+        _SESSION_RECENT.pop(sid, None)
+    return data
 
 def create_session_with_id(sid: str) -> str:
-    path = SESSIONS_DIR / f"{sid}.json"
-    if path.exists():
+    with _session_cache_lock:
+        if sid in _SESSION_CACHE:
+            return sid
+    if _session_header_path(sid).exists():
+        return sid
+    # a legacy json session must be migrated, not shadowed by a fresh header
+    if (SESSIONS_DIR / f"{sid}.json").exists():
+        load_session(sid)
         return sid
-    data = {"id": sid, "created_at": datetime.utcnow().isoformat(), "messages": []}
-    path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+    header = {"id": sid, "created_at": datetime.utcnow().isoformat()}
+    _session_header_path(sid).write_bytes(_msgpack_encoder.encode(header))
+    with _session_cache_lock:
+        _SESSION_CACHE[sid] = {**header, "messages": []}
+        _SESSION_LOG_SIZE[sid] = 0
     return sid
 
+def recent_messages(sid: str) -> deque:
+    with _session_cache_lock:
+        recent = _SESSION_RECENT.get(sid)
+    if recent is not None:
+        return recent
+    data = load_session(sid)
+    tail = data["messages"][-RECENT_MESSAGES:] if data else []
+    recent = deque(tail, maxlen=RECENT_MESSAGES)
+    with _session_cache_lock:
+        return _SESSION_RECENT.setdefault(sid, recent)
+
 def append_session_message(sid: str, role: str, text: str, meta: Optional[dict]=None):
-    path = SESSIONS_DIR / f"{sid}.json"
-    if not path.exists():
-        logging.warning("append_session_message: session not found %s. Creating new.", sid)
-        _ = create_session_with_id(sid)
     data = load_session(sid)
-    data["messages"].append({
+    if data is None:
+        logging.warning("append_session_message: session not found %s. Creating new.", sid)
+        create_session_with_id(sid)
+        data = load_session(sid)
+    message = {
         "role": role,
         "text": text,
         "meta": meta or {},
-        "ts": datetime.utcnow().isoformat()
-    })
-    path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+        # float epoch seconds: msgpack-native and far cheaper than building
+        # and formatting a datetime per message
+        "ts": time.time()
+    }
+    # grab the ring before mutating so a first build doesn't double-count
+    recent = recent_messages(sid)
+    data["messages"].append(message)
+    recent.append(message)
+    buf = _msgpack_encoder.encode(message)
+    frame = struct.pack(">I", len(buf)) + buf
+    with _pending_lock:
+        pending = _PENDING[sid]
+        pending += frame
+        should_flush = len(pending) >= FLUSH_THRESHOLD
+    with _session_cache_lock:
+        _SESSION_LOG_SIZE[sid] = _SESSION_LOG_SIZE.get(sid, 0) + len(frame)
+    if should_flush:
+        _flush_pending(sid)
 
 # ---------- Brief generation ----------
-def create_production_brief(system_prompt: str, history: list, user_prompt: str) -> Tuple[str, str]:
+def create_production_brief(system_prompt: str, history, user_prompt: str) -> Tuple[str, str]:
     history_snippet = ""
     if history:
-        last = history[-6:]
+        last = list(history)[-6:]
         history_snippet = " | ".join([f"{m['role']}: {m['text']}" for m in last])
 
     brief_parts = []
@@ -141,154 +464,213 @@ def create_production_brief(system_prompt: str, history: list, user_prompt: str)
     return brief, assistant_reply
 
 # ---------- helpers to download and handle replicate outputs ----------
+# Shared pool so multi-item replicate outputs download in parallel
+_download_executor = ThreadPoolExecutor(max_workers=8)
+
+# One session for all CDN downloads: keep-alive sockets skip the TCP+TLS
+# handshake on every file, and transient 5xx responses are retried
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+))
+
+# single C-level regex instead of six substring scans; anchoring on end /
+# query / fragment also handles signed URLs like video.mp4?token=...
+_EXT_RE = re.compile(r"\.(mp4|webm|gif)(?:$|[?#/])", re.I)
+
 def _guess_ext_from_url(url: str) -> str:
-    if url.endswith(".mp4") or ".mp4" in url:
-        return ".mp4"
-    if url.endswith(".webm") or ".webm" in url:
-        return ".webm"
-    if url.endswith(".gif") or ".gif" in url:
-        return ".gif"
-    return ".mp4"
+    m = _EXT_RE.search(url)
+    return f".{m.group(1).lower()}" if m else ".mp4"
+
+def _copy_via_io_uring(src, fd: int, chunk_size: int = 1024 * 1024, depth: int = 8):
+    """Write src's contents to fd through io_uring: up to `depth` chunk writes
+    are queued and submitted with one io_uring_enter instead of one write
+    syscall per chunk. Short writes (e.g. near-ENOSPC) are completed with
+    pwrite so later chunks, already queued at precomputed offsets, can't
+    leave a hole."""
+    ring = liburing.Ring()
+    liburing.io_uring_queue_init(depth, ring)
+    cqe = liburing.Cqe()
+    try:
+        offset = 0
+        while True:
+            # batch holds (chunk, offset) so buffers stay alive until
+            # completion and short writes know where to resume
+            batch = []
+            while len(batch) < depth:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                sqe = liburing.io_uring_get_sqe(ring)
+                liburing.io_uring_prep_write(sqe, fd, chunk, offset)
+                # completions can arrive out of order; tag with batch index
+                liburing.io_uring_sqe_set_data64(sqe, len(batch))
+                batch.append((chunk, offset))
+                offset += len(chunk)
+            if not batch:
+                break
+            liburing.io_uring_submit(ring)
+            for _ in batch:
+                liburing.io_uring_wait_cqe(ring, cqe)
+                entry = cqe[0]
+                written = liburing.trap_error(entry.res)
+                chunk, chunk_offset = batch[entry.user_data]
+                liburing.io_uring_cq_advance(ring, 1)
+                while written < len(chunk):
+                    n = os.pwrite(fd, memoryview(chunk)[written:], chunk_offset + written)
+                    if n == 0:
+                        raise OSError(f"pwrite wrote 0 bytes at offset {chunk_offset + written}")
+                    written += n
+    finally:
+        liburing.io_uring_queue_exit(ring)
+
+def _stream_to_path(src, out_path: Path):
+    if liburing is not None:
+        fd = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            _copy_via_io_uring(src, fd)
+        finally:
+            os.close(fd)
+    else:
+        # copyfileobj with 1 MiB buffers runs the copy loop in C instead of
+        # iterating thousands of 8 KiB chunks in Python
+        with open(out_path, "wb") as f:
+            shutil.copyfileobj(src, f, 1024 * 1024)
 
 def _download_to_file(url: str) -> str:
     out_path = VIDEO_DIR / f"{uuid.uuid4().hex}{_guess_ext_from_url(url)}"
     logging.info("Downloading generated video %s -> %s", url, out_path)
-    r = requests.get(url, stream=True, timeout=180)
-    r.raise_for_status()
-    with open(out_path, "wb") as f:
-        for chunk in r.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
+    with SESSION.get(url, stream=True, timeout=180) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        _stream_to_path(r.raw, out_path)
+    VIDEO_INDEX.add(out_path.name)
     return str(out_path)
 
 def _write_bytes_to_file(data: bytes, ext: str = ".mp4") -> str:
     out_path = VIDEO_DIR / f"{uuid.uuid4().hex}{ext}"
     Path(out_path).write_bytes(data)
+    VIDEO_INDEX.add(out_path.name)
     return str(out_path)
 
+# Extraction strategies for the many shapes replicate outputs come in. Each
+# takes an item and returns local file paths (empty list = not my shape).
+def _handle_str(item) -> List[str]:
+    if isinstance(item, str) and item.startswith("http"):
+        return [_download_to_file(item)]
+    return []
+
+def _handle_dict(item) -> List[str]:
+    if not isinstance(item, dict):
+        return []
+    for key in ("url", "output_url", "download_url", "file", "artifact", "data"):
+        v = item.get(key)
+        if isinstance(v, str) and v.startswith("http"):
+            return [_download_to_file(v)]
+        if isinstance(v, (bytes, bytearray)):
+            return [_write_bytes_to_file(bytes(v), ".mp4")]
+    return []
+
+def _handle_url_attr(item) -> List[str]:
+    # covers both property-style .url and callable .url()
+    url = getattr(item, "url", None)
+    if callable(url):
+        try:
+            url = url()
+        except TypeError:
+            url = None
+    # sometimes .url() returns a FileOutput-like object with its own .url
+    nested = getattr(url, "url", None)
+    if isinstance(nested, str):
+        url = nested
+    if isinstance(url, str) and url.startswith("http"):
+        return [_download_to_file(url)]
+    return []
+
+def _handle_read(item) -> List[str]:
+    read_fn = getattr(item, "read", None)
+    if callable(read_fn):
+        data = read_fn()
+        if isinstance(data, (bytes, bytearray)):
+            return [_write_bytes_to_file(bytes(data), ".mp4")]
+    return []
+
+def _handle_open(item) -> List[str]:
+    open_fn = getattr(item, "open", None)
+    if not callable(open_fn):
+        return []
+    fobj = open_fn()
+    try:
+        data = fobj.read()
+    finally:
+        try:
+            fobj.close()
+        except Exception:
+            pass
+    if isinstance(data, (bytes, bytearray)):
+        return [_write_bytes_to_file(bytes(data), ".mp4")]
+    return []
+
+def _handle_stream(item) -> List[str]:
+    stream_fn = getattr(item, "stream", None)
+    if not callable(stream_fn):
+        return []
+    stream = stream_fn()
+    out_path = VIDEO_DIR / f"{uuid.uuid4().hex}.mp4"
+    if hasattr(stream, "read"):
+        _stream_to_path(stream, out_path)
+    else:
+        with open(out_path, "wb") as f:
+            for chunk in stream:
+                if isinstance(chunk, (bytes, bytearray)):
+                    f.write(chunk)
+    VIDEO_INDEX.add(out_path.name)
+    return [str(out_path)]
+
+def _handle_download(item) -> List[str]:
+    download_fn = getattr(item, "download", None) or getattr(item, "save", None)
+    if not callable(download_fn):
+        return []
+    out_path = VIDEO_DIR / f"{uuid.uuid4().hex}.mp4"
+    res = download_fn(str(out_path))
+    # download_fn may return a path or write the file in place
+    if isinstance(res, str) and Path(res).exists():
+        VIDEO_INDEX.add(Path(res).name)
+        return [res]
+    if out_path.exists():
+        VIDEO_INDEX.add(out_path.name)
+        return [str(out_path)]
+    return []
+
+# Ordered by how common each shape is in practice: the typical string-URL
+# output resolves with a single isinstance check and no getattr probing
+_STRATEGIES = (
+    _handle_str,
+    _handle_dict,
+    _handle_url_attr,
+    _handle_read,
+    _handle_open,
+    _handle_stream,
+    _handle_download,
+)
+
 def _process_replicate_item(item) -> List[str]:
     """
-    Try multiple strategies to extract/download a video from a replicate output item.
-    Returns list of local file paths (0 or more).
+    Try the extraction strategies in order until one yields a video from a
+    replicate output item. Returns list of local file paths (0 or more).
     """
-    out_paths: List[str] = []
-
-    # 1) string URL
-    try:
-        if isinstance(item, str) and item.startswith("http"):
-            out_paths.append(_download_to_file(item))
-            return out_paths
-    except Exception:
-        logging.exception("Error processing string item")
-
-    # 2) callable .url()
-    try:
-        url_callable = getattr(item, "url", None)
-        if callable(url_callable):
-            try:
-                url_val = url_callable()
-                if isinstance(url_val, str) and url_val.startswith("http"):
-                    out_paths.append(_download_to_file(url_val))
-                    return out_paths
-                # Sometimes .url() returns a FileOutput-like object with .url property:
-                if hasattr(url_val, "url") and isinstance(url_val.url, str) and url_val.url.startswith("http"):
-                    out_paths.append(_download_to_file(url_val.url))
-                    return out_paths
-            except TypeError:
-                # some .url attributes are property-like; handled below
-                pass
-            except Exception:
-                logging.exception("Calling item.url() failed")
-    except Exception:
-        logging.exception("Checking item.url failed")
-
-    # 3) property .url (non-callable)
-    try:
-        url_prop = getattr(item, "url", None)
-        if isinstance(url_prop, str) and url_prop.startswith("http"):
-            out_paths.append(_download_to_file(url_prop))
-            return out_paths
-    except Exception:
-        logging.exception("item.url property check failed")
-
-    # 4) .read() -> bytes
-    try:
-        read_fn = getattr(item, "read", None)
-        if callable(read_fn):
-            data = read_fn()
-            if isinstance(data, (bytes, bytearray)):
-                out_paths.append(_write_bytes_to_file(bytes(data), ".mp4"))
-                return out_paths
-    except Exception:
-        logging.exception("Calling item.read() failed")
-
-    # 5) .open() -> file-like
-    try:
-        open_fn = getattr(item, "open", None)
-        if callable(open_fn):
-            fobj = open_fn()
-            try:
-                data = fobj.read()
-                if isinstance(data, (bytes, bytearray)):
-                    out_paths.append(_write_bytes_to_file(bytes(data), ".mp4"))
-                    return out_paths
-            finally:
-                try:
-                    fobj.close()
-                except Exception:
-                    pass
-    except Exception:
-        logging.exception("item.open() handling failed")
-
-    # 6) .stream() -> iterable chunks
-    try:
-        stream_fn = getattr(item, "stream", None)
-        if callable(stream_fn):
-            stream = stream_fn()
-            out_path = VIDEO_DIR / f"{uuid.uuid4().hex}.mp4"
-            with open(out_path, "wb") as f:
-                for chunk in stream:
-                    if isinstance(chunk, (bytes, bytearray)):
-                        f.write(chunk)
-            out_paths.append(str(out_path))
-            return out_paths
-    except Exception:
-        logging.exception("item.stream() handling failed")
-
-    # 7) download/save methods
-    try:
-        download_fn = getattr(item, "download", None) or getattr(item, "save", None)
-        if callable(download_fn):
-            out_path = VIDEO_DIR / f"{uuid.uuid4().hex}.mp4"
-            try:
-                res = download_fn(str(out_path))
-                # if download_fn returns a path or writes file, check
-                if isinstance(res, str) and Path(res).exists():
-                    out_paths.append(res)
-                    return out_paths
-                if Path(out_path).exists():
-                    out_paths.append(str(out_path))
-                    return out_paths
-            except Exception:
-                logging.exception("item.download/save() failed")
-    except Exception:
-        logging.exception("item.download/save check failed")
-
-    # 8) dict-like: try common keys
-    try:
-        if isinstance(item, dict):
-            for key in ("url", "output_url", "download_url", "file", "artifact", "data"):
-                v = item.get(key)
-                if isinstance(v, str) and v.startswith("http"):
-                    out_paths.append(_download_to_file(v))
-                    return out_paths
-                elif isinstance(v, (bytes, bytearray)):
-                    out_paths.append(_write_bytes_to_file(bytes(v), ".mp4"))
-                    return out_paths
-    except Exception:
-        logging.exception("dict-like item handling failed")
+    for strategy in _STRATEGIES:
+        try:
+            paths = strategy(item)
+        except Exception:
+            logging.exception("%s failed for item type %s", strategy.__name__, type(item))
+            continue
+        if paths:
+            return paths
 
-    # 9) last resort debug logging
+    # last resort debug logging
     try:
         logging.info("Unrecognized replicate output item type: %s", type(item))
         logging.info("repr(item)[:500]: %s", repr(item)[:500])
@@ -296,34 +678,26 @@ def _process_replicate_item(item) -> List[str]:
     except Exception:
         pass
 
-    return out_paths
+    return []
 
-def call_replicate_minimax(prompt: str, options: Optional[dict] = None, timeout: int = 600) -> List[str]:
-    """
-    Call Replicate model minimax/video-01 using replicate.run (python client).
-    Uses FAST_DEFAULTS and simple caching to speed up repeated prompts.
-    Returns list of local file paths of downloaded videos.
-    """
-    if not REPLICATE_API_TOKEN:
-        raise RuntimeError("REPLICATE_API_TOKEN not configured")
-
-    if replicate is None:
-        raise RuntimeError("replicate package not installed. pip install replicate")
-
-    # cache check
-    norm = _normalize_prompt(prompt)
-    cached = cache.get(norm)
-    if cached and Path(cached).exists():
-        logging.info("Cache hit for prompt: %s -> %s", norm, cached)
-        return [cached]
+# Futures for generations currently running, keyed by normalized prompt.
+# Concurrent requests for the same prompt wait on the first submitter's
+# future instead of firing duplicate (and billed) Replicate jobs.
+_INFLIGHT: Dict[str, Any] = {}
+_inflight_lock = threading.Lock()
+_generate_executor = ThreadPoolExecutor(max_workers=8)
 
+def _do_replicate(prompt: str, norm: str, options: Optional[dict]) -> List[str]:
     # merge options with fast defaults (user overrides allowed)
     merged_opts = {**FAST_DEFAULTS, **(options or {})}
 
     input_payload: Dict[str, Any] = {"prompt": prompt}
     input_payload.update(merged_opts)
 
-    logging.info("Calling Replicate model %s prompt=%s options=%s", REPLICATE_MODEL, prompt[:120], {k: merged_opts.get(k) for k in ("duration","fps","width","height","steps","samples") if k in merged_opts})
+    logging.info("Calling Replicate model %s prompt=%s", REPLICATE_MODEL, prompt[:120])
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        # the options dict render is only worth building when debug is on
+        logging.debug("Replicate options=%s", {k: merged_opts.get(k) for k in ("duration","fps","width","height","steps","samples") if k in merged_opts})
 
     start = time.time()
     try:
@@ -339,11 +713,16 @@ def call_replicate_minimax(prompt: str, options: Optional[dict] = None, timeout:
 
     # output can be many shapes
     if isinstance(output, list):
-        for item in output:
+        def _process_item_safe(item) -> List[str]:
             try:
-                downloaded.extend(_process_replicate_item(item))
+                return _process_replicate_item(item)
             except Exception:
                 logging.exception("Failed to process item in output list")
+                return []
+        # each item download is a synchronous requests.get; fan them across
+        # the shared pool so N files come down in parallel
+        for paths in _download_executor.map(_process_item_safe, output):
+            downloaded.extend(paths)
     else:
         try:
             downloaded.extend(_process_replicate_item(output))
@@ -367,14 +746,82 @@ def call_replicate_minimax(prompt: str, options: Optional[dict] = None, timeout:
 
     # cache first downloaded file
     try:
-        cache[norm] = downloaded[0]
-        _save_cache(cache)
+        _cache_put(norm, downloaded[0])
         logging.info("Saved generation to cache for prompt: %s -> %s", norm, downloaded[0])
     except Exception:
         logging.exception("Failed to save to cache")
 
     return downloaded
 
+def call_replicate_minimax(prompt: str, options: Optional[dict] = None, timeout: int = 600) -> List[str]:
+    """
+    Call Replicate model minimax/video-01 using replicate.run (python client).
+    Uses FAST_DEFAULTS and simple caching to speed up repeated prompts;
+    concurrent requests for the same prompt share one in-flight job.
+    Returns list of local file paths of downloaded videos.
+    """
+    if not REPLICATE_API_TOKEN:
+        raise RuntimeError("REPLICATE_API_TOKEN not configured")
+
+    if replicate is None:
+        raise RuntimeError("replicate package not installed. pip install replicate")
+
+    # cache check
+    norm = _normalize_prompt(prompt)
+    cached = cache.get(norm)
+    if cached and Path(cached).exists():
+        logging.info("Cache hit for prompt: %s -> %s", norm, cached)
+        return [cached]
+
+    with _inflight_lock:
+        fut = _INFLIGHT.get(norm)
+        submitter = fut is None
+        if submitter:
+            fut = _generate_executor.submit(_do_replicate, prompt, norm, options)
+            _INFLIGHT[norm] = fut
+        else:
+            logging.info("Joining in-flight generation for prompt: %s", norm)
+
+    if not submitter:
+        return fut.result(timeout=timeout)
+    try:
+        return fut.result(timeout=timeout)
+    finally:
+        # only the submitter removes the entry so late joiners still find it
+        with _inflight_lock:
+            _INFLIGHT.pop(norm, None)
+
+def _materialize_sample(out_path: Path):
+    """Place a copy of the sample asset at out_path without re-reading it from
+    disk: hard link when possible (one inode op, zero data copy), falling back
+    to writing the preloaded bytes across filesystems."""
+    try:
+        os.link(SAMPLE_ASSET, out_path)
+    except OSError:
+        out_path.write_bytes(SAMPLE_BYTES)
+
+# ---------- Background generation (optional) ----------
+# With REDIS_URL set and celery installed, POST /api/generate-video enqueues a
+# task and returns 202 immediately; clients poll GET /api/job/<id> for the
+# result. Without a broker the synchronous flow below is unchanged.
+celery = None
+if Celery is not None and REDIS_URL:
+    celery = Celery("peppo", broker=REDIS_URL, backend=REDIS_URL)
+
+    @celery.task(name="peppo.generate_video")
+    def generate_task(brief: str, options: dict, sid: str) -> str:
+        gen_start = time.time()
+        files = call_replicate_minimax(brief, options=options)
+        if not files:
+            raise RuntimeError("Replicate returned no downloadable files")
+        out_file = files[0]
+        append_session_message(sid, "assistant", f"[VIDEO GENERATED] brief={brief}", meta={"video": str(Path(out_file).name), "mock": False, "elapsed": time.time() - gen_start})
+        # flush synchronously: no request teardown fires here, the timer
+        # thread doesn't survive the prefork fork, and billiard children
+        # exit without running atexit hooks
+        _flush_pending(sid)
+        return out_file
+
 # ---------- Routes ----------
 @app.route("/api/session", methods=["POST"])
 def create_session_route():
@@ -396,8 +843,7 @@ def generate_video():
 
     append_session_message(sid, "user", user_prompt, meta={"source": "frontend"})
 
-    session_data = load_session(sid) or {}
-    history = session_data.get("messages", [])
+    history = recent_messages(sid)
     brief, assistant_reply = create_production_brief(SYSTEM_PROMPT, history, user_prompt)
     append_session_message(sid, "assistant", assistant_reply, meta={"brief": brief})
 
@@ -406,27 +852,37 @@ def generate_video():
     # If replicate not configured -> return mock sample
     if not REPLICATE_API_TOKEN or not REPLICATE_MODEL or replicate is None:
         logging.warning("Replicate not configured or client missing. Returning mock sample for session %s", sid)
-        if not SAMPLE_ASSET.exists():
+        if SAMPLE_BYTES is None:
             return jsonify({"error": "Replicate not configured and no sample available."}), 500
         out_path = VIDEO_DIR / f"{uuid.uuid4().hex}.mp4"
-        out_path.write_bytes(SAMPLE_ASSET.read_bytes())
+        _materialize_sample(out_path)
+        VIDEO_INDEX.add(out_path.name)
         append_session_message(sid, "assistant", f"[MOCK VIDEO SERVED] brief={brief}", meta={"video": str(out_path.name), "mock": True})
-        resp = make_response(send_file(str(out_path), mimetype="video/mp4", as_attachment=False))
+        resp = make_response(send_file(str(out_path), mimetype="video/mp4", as_attachment=False, conditional=True))
         resp.headers["X-Session-Id"] = sid
         resp.headers["X-Video-Mock"] = "true"
         return resp
 
+    # With a broker configured, hand the generation to a worker and return
+    # immediately instead of pinning this request for the Replicate round-trip
+    if celery is not None:
+        task = generate_task.delay(brief, user_options, sid)
+        resp = jsonify({"job_id": task.id, "session_id": sid, "status_url": f"/api/job/{task.id}"})
+        resp.headers["X-Session-Id"] = sid
+        return resp, 202
+
     # Call Replicate (fast defaults merged with user options)
     gen_start = time.time()
     try:
         files = call_replicate_minimax(brief, options=user_options)
     except Exception as e:
         logging.exception("Replicate call failed for session %s: %s", sid, e)
-        if SAMPLE_ASSET.exists():
+        if SAMPLE_BYTES is not None:
             out_path = VIDEO_DIR / f"{uuid.uuid4().hex}.mp4"
-            out_path.write_bytes(SAMPLE_ASSET.read_bytes())
+            _materialize_sample(out_path)
+            VIDEO_INDEX.add(out_path.name)
             append_session_message(sid, "assistant", f"[MOCK VIDEO SERVED AFTER REPLICATE ERROR] brief={brief}", meta={"video": str(out_path.name), "mock": True, "replicate_error": str(e)})
-            resp = make_response(send_file(str(out_path), mimetype="video/mp4", as_attachment=False))
+            resp = make_response(send_file(str(out_path), mimetype="video/mp4", as_attachment=False, conditional=True))
             resp.headers["X-Session-Id"] = sid
             resp.headers["X-Video-Mock"] = "true"
             return resp
@@ -440,12 +896,26 @@ def generate_video():
 
     out_file = files[0]
     append_session_message(sid, "assistant", f"[VIDEO GENERATED] brief={brief}", meta={"video": str(Path(out_file).name), "mock": False, "elapsed": gen_elapsed})
-    resp = make_response(send_file(str(out_file), mimetype="video/mp4", as_attachment=False))
+    resp = make_response(send_file(str(out_file), mimetype="video/mp4", as_attachment=False, conditional=True))
     resp.headers["X-Session-Id"] = sid
     resp.headers["X-Video-Mock"] = "false"
     resp.headers["X-Generation-Time"] = f"{gen_elapsed:.2f}"
     return resp
 
+@app.route("/api/job/<job_id>", methods=["GET"])
+def job_status(job_id):
+    if celery is None:
+        return jsonify({"error": "background jobs not configured"}), 501
+    result = celery.AsyncResult(job_id)
+    if result.successful():
+        out_file = result.result
+        if not out_file or not Path(out_file).exists():
+            return jsonify({"state": result.state, "error": "generated file missing"}), 500
+        return make_response(send_file(str(out_file), mimetype="video/mp4", as_attachment=False, conditional=True))
+    if result.failed():
+        return jsonify({"state": result.state, "error": str(result.result)}), 500
+    return jsonify({"state": result.state}), 202
+
 @app.route("/api/session-history/<session_id>", methods=["GET"])
 def session_history(session_id):
     s = load_session(session_id)
@@ -455,8 +925,13 @@ def session_history(session_id):
 
 @app.route("/api/list-videos", methods=["GET"])
 def list_videos():
-    files = [f.name for f in VIDEO_DIR.iterdir() if f.suffix in (".mp4", ".webm", ".gif")]
-    return jsonify({"videos": files})
+    global VIDEO_INDEX, _video_index_scanned
+    now = time.monotonic()
+    if now - _video_index_scanned > VIDEO_INDEX_TTL:
+        # pick up files landed by other workers; still O(1) between rescans
+        VIDEO_INDEX = _scan_video_dir()
+        _video_index_scanned = now
+    return jsonify({"videos": list(VIDEO_INDEX)})
 
 @app.route("/api/health", methods=["GET"])
 def health():
@@ -467,4 +942,6 @@ def hi():
     return jsonify({"HELLO": True})
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8000)), debug=True)
+    # Dev server only. Production runs under gunicorn's gevent worker via
+    # wsgi.py (see Procfile) so blocking Replicate calls don't pin workers.
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8000)))
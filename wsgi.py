@@ -0,0 +1,8 @@
+# wsgi.py
+# Gunicorn gevent entrypoint. monkey.patch_all() must run before app (and
+# therefore requests/replicate) is imported so socket waits yield to the event
+# loop instead of pinning a worker for the whole Replicate round-trip.
+from gevent import monkey
+monkey.patch_all()
+
+from app import app  # noqa: E402